@@ -1,16 +1,25 @@
 import hashlib
+import io
 import os
-import re
 import sys
 import logging
+import threading
+import requests
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from domino import Domino
 from pathlib import Path
-from typing import Any, List, Dict, Optional, Union
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from typing import Any, ClassVar, List, Dict, Optional, Tuple, Union
 from urllib.parse import urlparse, urlunparse
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
 
 logging.basicConfig(
     level=os.getenv("LOG_LEVEL", "INFO").upper(),
@@ -18,6 +27,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger("domino-environment-automation")
 
+# Guards the name -> ID map shared between EnvironmentConfig instances
+_existing_environments_lock = threading.Lock()
+
+
+def _is_object_id(value):
+    """Check for a 24-character hex MongoDB ObjectID, as used for Domino IDs."""
+    if not isinstance(value, str) or len(value) != 24:
+        return False
+    try:
+        # fromhex skips whitespace, so also require all 12 bytes to be decoded
+        return len(bytes.fromhex(value)) == 12
+    except ValueError:
+        return False
+
+
 @dataclass
 class ProxyConfig:
     port: int
@@ -35,74 +59,71 @@ class WorkspaceTool:
     proxyConfig: Optional[ProxyConfig] = None
 
 
+@dataclass(slots=True)
 class EnvironmentConfig:
-    def __init__(
-        self,
-        environment_config_location,
-        environment_id: str = "",
-        dockerfile_instructions: str = "",
-        environment_variables: List[Dict[str, Any]] = None,
-        base_image: str = "",
-        post_run_script: str = "",
-        post_setup_script: str = "",
-        pre_run_script: str = "",
-        pre_setup_script: str = "",
-        skip_cache: bool = False,
-        summary: str = "",
-        supported_clusters: List[str] = None,
-        tags: List[str] = None,
-        use_vpn: bool = False,
-        workspace_tools: List[Dict[str, Any]] = None,
-        add_base_dependencies: bool = True,
-        description : Union[str, List[str]] = None,
-        is_restricted: bool = True,
-        name: str = "",
-        organization_owner_id: str = "",
-        visibility: str = "Private",
-        config_file_hash : str = ""
-    ):
-
-        self.environment_config_location = environment_config_location
-        self.environment_id = environment_id
-        self.dockerfile_instructions = dockerfile_instructions
-        self.environment_variables = environment_variables or []
-        self.base_image = base_image
-        self.post_run_script = post_run_script
-        self.post_setup_script = post_setup_script
-        self.pre_run_script = pre_run_script
-        self.pre_setup_script = pre_setup_script
-        self.skip_cache = skip_cache
-        self.summary = summary
-        self.supported_clusters = supported_clusters or []
-        self.tags = tags or []
-        self.use_vpn = use_vpn
-        self.workspace_tools = workspace_tools or []
-        self.add_base_dependencies = add_base_dependencies
-        self.description = description
-        self.is_restricted = is_restricted
-        self.name = name
-        self.organization_owner_id = organization_owner_id
-        self.visibility = visibility
-        self.config_file_hash = config_file_hash
-
-
-    def get_environment_visibility(self):
-        with open(self.environment_config_location, 'r') as environment_config:
-            config = yaml.safe_load(environment_config)
-
+    # (attribute, environment.yaml key, default when missing or empty)
+    _FIELDS: ClassVar[List[Tuple[str, str, Any]]] = [
+        ("name",                    "name",                     ""),
+        ("base_image",              "image",                    ""),
+        ("dockerfile_instructions", "dockerfileInstructions",   ""),
+        ("environment_variables",   "environmentVariables",     []),
+        ("pre_setup_script",        "preSetupScript",           ""),
+        ("post_setup_script",       "postSetupScript",          ""),
+        ("pre_run_script",          "preRunScript",             ""),
+        ("post_run_script",         "postRunScript",            ""),
+        ("skip_cache",              "skipCache",                False),
+        ("summary",                 "summary",                  ""),
+        ("tags",                    "tags",                     []),
+        ("use_vpn",                 "useVpn",                   False),
+        ("description",             "description",              ""),
+        ("is_restricted",           "isRestricted",             False),
+        ("organization_owner_id",   "organizationOwnerId",      ""),
+    ]
+
+    environment_config_location: Path
+    environment_id: str = ""
+    dockerfile_instructions: str = ""
+    environment_variables: List[Dict[str, Any]] = field(default_factory=list)
+    base_image: str = ""
+    post_run_script: str = ""
+    post_setup_script: str = ""
+    pre_run_script: str = ""
+    pre_setup_script: str = ""
+    skip_cache: bool = False
+    summary: str = ""
+    supported_clusters: List[str] = field(default_factory=list)
+    tags: List[str] = field(default_factory=list)
+    use_vpn: bool = False
+    workspace_tools: List[Dict[str, Any]] = field(default_factory=list)
+    add_base_dependencies: bool = True
+    description : Union[str, List[str]] = None
+    is_restricted: bool = True
+    name: str = ""
+    organization_owner_id: str = ""
+    visibility: str = "Private"
+    config_file_hash : str = ""
+    existing_environments: Optional[Dict[str, str]] = field(default=None, repr=False)
+    _config: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False)
+    _config_bytes: Optional[bytes] = field(default=None, init=False, repr=False)
+    _is_parsed: bool = field(default=False, init=False, repr=False)
+    _env_spec: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False)
+
+
+    def get_environment_visibility(self, config):
         possible_visibility_types = ["Global", "Organization", "Private"]
 
-        self.visibility = config.get("visibility").title() if config.get("visibility") else "Private"
+        self.visibility = (config.get("visibility") or "Private").title()
 
         if self.visibility.upper() == "Organisation":
             self.visibility = "Organization"
 
-        if self.visibility == "Organization" and not config.get("organizationOwnerId"):
+        organization_owner_id = config.get("organizationOwnerId")
+        if self.visibility == "Organization" and not organization_owner_id:
             logger.error("Please provide the ID of an Organization that will own this environment")
             return
-        elif config.get("organizationOwnerId"):
-            self.organization_owner_id = config.get("organizationOwnerId")
-            if not re.search("^[0-9a-fA-F]{24}$", self.organization_owner_id):
+        elif organization_owner_id:
+            self.organization_owner_id = organization_owner_id
+            if not _is_object_id(self.organization_owner_id):
                 logger.error(f"Organization Owner ID {self.organization_owner_id} not recognised.")
                 return
             else:
@@ -113,13 +134,10 @@ class EnvironmentConfig:
             self.visibility = "Private"
 
 
-    def get_supported_clusters(self):
-        with open(self.environment_config_location, 'r') as environment_config:
-            config = yaml.safe_load(environment_config)
-
+    def get_supported_clusters(self, config):
         possible_cluster_types = ["Spark", "Ray", "Dask", "Mpi"]
 
-        self.supported_clusters = config.get("supportedClusters") if config.get("supportedClusters") else []
+        self.supported_clusters = config.get("supportedClusters") or []
         # Normalize case to Title for comparison (e.g., "spark" -> "Spark")
         self.supported_clusters = [str(sc).title() for sc in self.supported_clusters]
 
@@ -130,93 +148,103 @@ class EnvironmentConfig:
                 self.supported_clusters = [sc for sc in self.supported_clusters if sc in possible_cluster_types]
 
 
-    def build_workspace_tools(self):
-        with open(self.environment_config_location, 'r') as environment_config:
-            config = yaml.safe_load(environment_config)
-            pwts = config.get("pluggableWorkspaceTools", {})
-            self.workspace_tools = []
-
-            for name, pwt_config in pwts.items():
-                proxy_config = pwt_config.get("httpProxy")
-                http_proxy = ProxyConfig(**proxy_config) if proxy_config else None
-
-                wt = WorkspaceTool(
-                    title = pwt_config["title"],
-                    iconUrl= pwt_config["iconUrl"],
-                    startScripts=pwt_config["start"],
-                    supportedFileExtensions=pwt_config.get("supportedFileExtensions",[]),
-                    proxyConfig = http_proxy,
-                )
-
-                workspace_tools_dict = {
-                    "iconUrl": wt.iconUrl if wt.iconUrl else "",
-                    "name": name,
-                    "proxyConfig": {
-                        "internalPath": wt.proxyConfig.internalPath if wt.proxyConfig and wt.proxyConfig.internalPath else "",
-                        "port": wt.proxyConfig.port if wt.proxyConfig and wt.proxyConfig.port else "",
-                        "requireSubdomain": wt.proxyConfig.requireSubdomain if wt.proxyConfig and wt.proxyConfig.requireSubdomain else False,
-                        "rewrite": wt.proxyConfig.rewrite if wt.proxyConfig and wt.proxyConfig.rewrite else False
-                    },
-                    "startScripts": wt.startScripts,
-                    "supportedFileExtensions": wt.supportedFileExtensions,
-                    "title": wt.title if wt.title else name
-                }
-                self.workspace_tools.append(workspace_tools_dict)
+    def build_workspace_tools(self, config):
+        pwts = config.get("pluggableWorkspaceTools", {})
+        self.workspace_tools = []
+
+        for name, pwt_config in pwts.items():
+            proxy_config = pwt_config.get("httpProxy")
+            # A default with port 0 lets the fields below be read without None checks; `or ""` turns that 0 into ""
+            http_proxy = ProxyConfig(**proxy_config) if proxy_config else ProxyConfig(port=0)
+
+            wt = WorkspaceTool(
+                title = pwt_config["title"],
+                iconUrl= pwt_config["iconUrl"],
+                startScripts=pwt_config["start"],
+                supportedFileExtensions=pwt_config.get("supportedFileExtensions",[]),
+                proxyConfig = http_proxy,
+            )
+
+            workspace_tools_dict = {
+                "iconUrl": wt.iconUrl or "",
+                "name": name,
+                "proxyConfig": {
+                    "internalPath": http_proxy.internalPath or "",
+                    "port": http_proxy.port or "",
+                    "requireSubdomain": http_proxy.requireSubdomain or False,
+                    "rewrite": http_proxy.rewrite or False
+                },
+                "startScripts": wt.startScripts,
+                "supportedFileExtensions": wt.supportedFileExtensions,
+                "title": wt.title or name
+            }
+            self.workspace_tools.append(workspace_tools_dict)
 
 
     def check_environment_exists(self):
-        existing_environments = domino.environments_list()
-        for ee in existing_environments['data']:
-            if ee["name"] == self.name:
-                self.environment_id = ee["id"]
-                return True
+        if self.existing_environments is None:
+            self.existing_environments = get_existing_environments()
+        with _existing_environments_lock:
+            environment_id = self.existing_environments.get(self.name)
+        if environment_id:
+            self.environment_id = environment_id
+            return True
         return None
 
 
     def compute_config_file_hash(self, algorithm='sha256'):
         """Compute the hash of a file using the specified algorithm."""
-        hash_func = hashlib.new(algorithm)
+        # Keep the raw bytes so the YAML can be parsed without reading the file again.
+        # hashlib.file_digest isn't used as the bytes are needed in memory regardless.
+        self._config_bytes = Path(self.environment_config_location).read_bytes()
+        self.config_file_hash = hashlib.new(algorithm, self._config_bytes).hexdigest()
 
-        with open(self.environment_config_location, 'rb') as file:
-            # Read the file in chunks of 8192 bytes
-            while chunk := file.read(8192):
-                hash_func.update(chunk)
 
-        self.config_file_hash = hash_func.hexdigest()
+    def load_config_file(self):
+        self.compute_config_file_hash()
+        # Name the in-memory stream so YAML errors still report the file path
+        stream = io.BytesIO(self._config_bytes)
+        stream.name = str(self.environment_config_location)
+        self._config = yaml.load(stream, Loader=_Loader)
+        # Needed on the unchanged path, which skips the full parse
+        self.name = self._config.get("name") or ""
+        self.is_restricted = self._config.get("isRestricted") or False
+
+
+    def config_file_unchanged(self):
+        """Return True if the environment already has an active revision tagged with the config file hash."""
+        if self._config is None:
+            self.load_config_file()
+        if not self.name or not self.check_environment_exists():
+            return False
+        return self.get_latest_revision()
 
 
     def parse_config_file(self):
-        with open(self.environment_config_location, 'r') as environment_config:
-            config = yaml.safe_load(environment_config)
-
-        self.name                           = config.get("name") if config.get("name") else ""
-        self.base_image                     = config.get("image") if config.get("image") else ""
-        self.dockerfile_instructions        = config.get("dockerfileInstructions") if config.get("dockerfileInstructions") else ""
-        self.environment_variables          = config.get("environmentVariables") if config.get("environmentVariables") else []
-        self.pre_setup_script               = config.get("preSetupScript") if config.get("preSetupScript") else ""
-        self.post_setup_script              = config.get("postSetupScript") if config.get("postSetupScript") else ""
-        self.pre_run_script                 = config.get("preRunScript") if config.get("preRunScript") else ""
-        self.post_run_script                = config.get("postRunScript") if config.get("postRunScript") else ""
-        self.skip_cache                     = config.get("skipCache") if config.get("skipCache") else False
-        self.summary                        = config.get("summary") if config.get("summary") else ""
-        self.tags                           = config.get("tags") if config.get("tags") else []
-        self.use_vpn                        = config.get("useVpn") if config.get("useVpn") else False
-        self.description                    = config.get("description") if config.get("description") else ""
-        self.is_restricted                  = config.get("isRestricted") if config.get("isRestricted") else False
-        self.organization_owner_id          = config.get("organizationOwnerId") if config.get("organizationOwnerId") else ""
-
-        self.get_environment_visibility()
-        self.get_supported_clusters()
-        self.build_workspace_tools()
+        if self._is_parsed:
+            return
+        if self._config is None:
+            self.load_config_file()
+        config = self._config
 
-        self.compute_config_file_hash()
+        for attr, key, default in self._FIELDS:
+            value = config.get(key) or default
+            # Copy list values so later appends don't touch the parsed YAML or the shared default
+            setattr(self, attr, list(value) if isinstance(default, list) else value)
+
+        self.get_environment_visibility(config)
+        self.get_supported_clusters(config)
+        self.build_workspace_tools(config)
+
+        # self.tags is a fresh copy from the loop above, and _is_parsed stops this running twice
         self.tags.append(self.config_file_hash)
+        self._is_parsed = True
 
 
     def create_environment(self):
         self.parse_config_file()
 
-        domino.create_environment(
+        created_environment = domino.create_environment(
             name                            = self.name,
             visibility                      = self.visibility,
             dockerfile_instructions         = self.dockerfile_instructions,
@@ -238,7 +266,20 @@ class EnvironmentConfig:
             organization_owner_id           = self.organization_owner_id
         )
 
-        self.check_environment_exists()
+        # Use the ID from the create response when present, only relisting environments as a fallback
+        environment_id = None
+        if isinstance(created_environment, dict):
+            environment_id = (created_environment.get("environment") or {}).get("id") or created_environment.get("id")
+        if environment_id:
+            self.environment_id = environment_id
+            # Record the new environment so later templates with the same name add revisions to it
+            with _existing_environments_lock:
+                self.existing_environments[self.name] = environment_id
+        else:
+            refreshed_environments = get_existing_environments()
+            with _existing_environments_lock:
+                self.existing_environments.update(refreshed_environments)
+            self.check_environment_exists()
 
 
     def create_environment_if_not_exist(self):
@@ -257,8 +298,15 @@ class EnvironmentConfig:
             return True
 
 
+    def _fetch_env(self, force=False):
+        """Return the environment spec from Domino, reusing the last response unless forced."""
+        if force or self._env_spec is None:
+            self._env_spec = domino.get_environment(self.environment_id)
+        return self._env_spec
+
+
     def get_latest_revision(self):
-        environment_spec = domino.get_environment(self.environment_id)
+        environment_spec = self._fetch_env()
         active_revision_tags = environment_spec["environment"].get("activeRevisionTags") or []
         tag_match = self.config_file_hash in active_revision_tags
         return tag_match
@@ -267,7 +315,7 @@ class EnvironmentConfig:
     def create_environment_revision(self):
         file_unchanged = self.get_latest_revision()
         if file_unchanged:
-           logger.info("File has not changed since last run")
+           logger.info(f"Environment {self.name} file has not changed since last run")
         else:
             domino.create_environment_revision(
                 environment_id          = self.environment_id,
@@ -285,16 +333,18 @@ class EnvironmentConfig:
                 use_vpn                 = self.use_vpn,
                 workspace_tools         = self.workspace_tools
             )
-            self.restrict_environment_revision()
+            # The new revision changes the selected revision, so refresh the cached spec
+            self._fetch_env(force=True)
+        self.restrict_environment_revision()
 
 
     def restrict_environment_revision(self):
-        get_environment = domino.get_environment(self.environment_id)
+        get_environment = self._fetch_env()
         restricted_revision = get_environment["environment"].get('restrictedRevision') or None
         selected_revision = get_environment["environment"].get('selectedRevision') or None
         if selected_revision:
             selected_revision_id = selected_revision["id"]
-            logger.debug(selected_revision_id)
+            logger.debug(f"Environment {self.name} selected revision: {selected_revision_id}")
             if not restricted_revision and self.is_restricted == True:
                 logger.debug("Restricting selected revision as environment is marked restricted")
                 domino.restrict_environment_revision(self.environment_id, selected_revision_id)
@@ -304,6 +354,34 @@ class EnvironmentConfig:
         domino.archive_environment(self.environment_id)
 
 
+def get_existing_environments():
+    """Map the name of every environment in Domino to its ID."""
+    return {ee["name"]: ee["id"] for ee in domino.environments_list()['data']}
+
+
+def get_max_workers():
+    max_workers = os.getenv("MAX_WORKERS", "8")
+    if not max_workers.isdigit() or int(max_workers) < 1:
+        logger.error(f"MAX_WORKERS must be a positive whole number, got '{max_workers}'.")
+        sys.exit(1)
+    return int(max_workers)
+
+
+def enable_connection_pooling(client, pool_size):
+    """Grow the Domino client's HTTPS connection pool so concurrent workers reuse connections."""
+    # requests already pools up to DEFAULT_POOLSIZE connections per host
+    if pool_size <= DEFAULT_POOLSIZE:
+        return
+    # python-domino sends every request through _HttpRequestManager.request_session
+    session = getattr(getattr(client, "request_manager", None), "request_session", None)
+    if not isinstance(session, requests.Session):
+        logger.debug("Domino client does not expose a requests session – using its default connection handling")
+        return
+    # Keep the client's retry policy when replacing the default adapter
+    max_retries = session.get_adapter("https://").max_retries
+    session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries))
+
+
 def get_domino_host():
     host = os.getenv("DOMINO_URL")
     if not host:
@@ -321,51 +399,86 @@ def get_domino_host():
 def get_target_directory():
     target_directory = os.getenv("TARGET_DIRECTORY")
     if not target_directory:
-        cwd_candidate = os.path.join(Path(os.getcwd()).absolute(), "environment_templates")
-        parent_candidate = os.path.join(Path(os.getcwd()).parent.absolute(), "environment_templates")
-        if os.path.isdir(cwd_candidate):
-            target_directory = cwd_candidate
-        elif os.path.isdir(parent_candidate):
-            target_directory = parent_candidate
-        else:
+        cwd = Path.cwd()
+        candidates = [cwd / "environment_templates", cwd.parent / "environment_templates"]
+        target_directory = next((c for c in candidates if c.is_dir()), None)
+        if target_directory is None:
             logger.error("Could not find 'environment_templates' in current or parent directory. Set TARGET_DIRECTORY or create the folder.")
             sys.exit(1)
-    elif not target_directory.endswith("/environment_templates"):
-        if target_directory.endswith("/"):
-            target_directory = os.path.join(target_directory, "environment_templates")
-        else:
-            target_directory = os.path.join(target_directory + "/environment_templates")
-    if not os.path.isdir(target_directory):
-        logger.error(f"Target directory does not exist: {target_directory}")
-        sys.exit(1)
+    else:
+        target_directory = Path(target_directory)
+        if target_directory.name != "environment_templates":
+            target_directory = target_directory / "environment_templates"
+        if not target_directory.is_dir():
+            logger.error(f"Target directory does not exist: {target_directory}")
+            sys.exit(1)
     logger.info(f"Target directory: {target_directory}")
     return target_directory
 
 
-def process_single_environment(environment, target_directory):
-    environment_config_location = Path(os.path.join(target_directory, environment, "environment.yaml"))
-    if not environment_config_location.exists():
+def load_environment_config(environment_directory, existing_environments=None):
+    environment = environment_directory.name
+    environment_config_location = environment_directory / "environment.yaml"
+    if not environment_config_location.is_file():
         logger.warning(f"No configuration file found for {environment}– skipping")
-        return
+        return None
+    try:
+        ec = EnvironmentConfig(
+            environment_config_location=environment_config_location,
+            existing_environments=existing_environments
+        )
+        ec.load_config_file()
+    except Exception as e:
+        logger.error(f"Failed to process environment '{environment}': {e}")
+        return None
+    return ec
+
+
+def process_single_environment(ec):
     try:
-        ec = EnvironmentConfig(environment_config_location=environment_config_location)
+        if ec.config_file_unchanged():
+            logger.info(f"Environment {ec.name} is unchanged since last run – skipping")
+            # Retry a restriction that may have failed after the last revision was created
+            ec.restrict_environment_revision()
+            return
         ec.parse_config_file()
         ec.create_environment_if_not_exist()
         ec.create_environment_revision()
-        ec.restrict_environment_revision()
     except Exception as e:
-        logger.error(f"Failed to process environment '{environment}': {e}")
+        logger.error(f"Failed to process environment '{ec.environment_config_location.parent.name}': {e}")
         return
 
 
+def process_environments_in_order(environment_configs):
+    for ec in environment_configs:
+        process_single_environment(ec)
+
+
 def process_all_environments(target_directory):
-    local_environments_list = os.listdir(target_directory)
+    # scandir caches the entry type, so non-directories are skipped without an extra stat
+    with os.scandir(target_directory) as entries:
+        local_environments_list = [Path(entry.path) for entry in entries if entry.is_dir()]
     if not local_environments_list:
         logger.error("No environments found to build!")
         sys.exit(1)
-    logger.info(f"Building environments: {local_environments_list}")
-    for environment in local_environments_list:
-        process_single_environment(environment, target_directory)
+    logger.info(f"Building environments: {[e.name for e in local_environments_list]}")
+    try:
+        existing_environments = get_existing_environments()
+    except Exception as e:
+        # Leave the map unset so each environment retries the lookup and logs its own failure
+        logger.error(f"Failed to list existing environments: {e}")
+        existing_environments = None
+
+    # Templates sharing a name target the same Domino environment, so each group runs in one worker
+    environments_by_name = {}
+    for environment_directory in local_environments_list:
+        ec = load_environment_config(environment_directory, existing_environments)
+        if ec:
+            environments_by_name.setdefault(ec.name, []).append(ec)
+
+    # Environments are independent and bound by Domino API latency, so process them concurrently
+    with ThreadPoolExecutor(max_workers=get_max_workers()) as executor:
+        list(executor.map(process_environments_in_order, environments_by_name.values()))
     sys.exit(0)
 
 
@@ -387,7 +500,8 @@ def main():
             logger.error("Please provide an environment variable DOMINO_API_KEY with your Domino API key, or DOMINO_AUTH_TOKEN with a Service Account token.")
             sys.exit(1)
         domino = Domino(domino_project, api_key=api_key, host=host, auth_token=auth_token)
-    
+    enable_connection_pooling(domino, get_max_workers())
+
     target_directory = get_target_directory()
     process_all_environments(target_directory)
 